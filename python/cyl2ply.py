@@ -1,9 +1,12 @@
 
-import math
+import os
 import numpy as np
 import sys
 import argparse
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from instrument import Profiler, add_profile_args, off
 
 # header needed in ply-file
 header = ["ply",
@@ -117,127 +120,149 @@ faces = [[3, 0, 3, 2],
          [3, 25, 2, 49],
          [3, 49, 2, 26]]
 
-def dot(v1,v2):
-    '''returns dot-product of two vectors'''
-    return sum(p*q for p,q in zip(v1,v2))
+# column names and types of the cyl_data and branch_data files written by save_model_text.m
+cyl_dtypes = {'radius':'f8', 'length':'f8', 'sx':'f8', 'sy':'f8', 'sz':'f8', 'ax':'f8', 'ay':'f8', 'az':'f8', 
+              'parent':'i4', 'extension':'i4', 'branch':'i4', 'BranchOrder':'i4', 'PositionInBranch':'i4', 
+              'added':'f4', 'UnmodRadius':'f8'}
+
+branch_dtypes = {'BOrd':'i4', 'BPar':'i4', 'BVol':'f8', 'BLen':'f8', 'BAng':'f8', 'BHei':'f8', 'BAzi':'f8', 'BDia':'f8'}
+
+def read_cyls(cylfile):
+
+    return pd.read_csv(cylfile, sep='\t', header=None, engine='c', 
+                       names=list(cyl_dtypes), dtype=cyl_dtypes)
+
+def read_branches(branchfile):
+
+    branch = pd.read_csv(branchfile, sep='\t', header=None, engine='c', 
+                         names=list(branch_dtypes), dtype=branch_dtypes)
+    branch.index = branch.index + 1 # otherwise branches are lablelled from 0
+
+    return branch
+
+def branch_file(cylfile):
 
-def rotation_matrix(A,angle):
-    '''returns the rotation matrix'''
-    c = math.cos(angle)
-    s = math.sin(angle)
-    R = [[A[0]**2+(1-A[0]**2)*c, A[0]*A[1]*(1-c)-A[2]*s, A[0]*A[2]*(1-c)+A[1]*s],
-         [A[0]*A[1]*(1-c)+A[2]*s, A[1]**2+(1-A[1]**2)*c, A[1]*A[2]*(1-c)-A[0]*s],
-         [A[0]*A[2]*(1-c)-A[1]*s, A[1]*A[2]*(1-c)+A[0]*s, A[2]**2+(1-A[2]**2)*c]]
-    return R
+    # only the filename is changed e.g. cyl_data_tree.txt -> branch_data_tree.txt
+    path, name = os.path.split(cylfile)
+    return os.path.join(path, name.replace('cyl', 'branch', 1))
+
+def filter_branches(branch, min_length=0, min_radius=0):
+
+    """
+    returns a boolean Series indexed by branch, a branch is kept if it passes
+    the length and radius thresholds and so do all of its parent branches
+    """
+
+    keep = np.ones(len(branch) + 1, dtype=bool) # index 0 is the parent of the stem
+    keep[1:] = (branch.BLen.values >= min_length) & (branch.BDia.values >= min_radius * 2)
+    parent = np.zeros(len(branch) + 1, dtype=int)
+    parent[1:] = branch.BPar.values
+
+    # each pass removes one more order of children of removed branches
+    while True:
+        pruned = keep & keep[parent]
+        if (pruned == keep).all(): break
+        keep = pruned
+
+    return pd.Series(keep[1:], index=branch.index)
 
 def load_cyls(cylfile, args):
 
-    cyls = pd.read_csv(cylfile,
-                       sep='\t', 
-                       names=['radius', 'length', 'sx', 'sy', 'sz', 'ax', 'ay', 'az', 'parent', 'extension', 
-                              'branch', 'BranchOrder', 'PositionInBranch', 'added', 'UnmodRadius'])
+    with Profiler('cyl2ply', cylfile, args.profile, args.cprofile) as prof:
+        load_cyls_(cylfile, args, prof)
+
+def load_cyls_(cylfile, args, prof=off):
 
-    if not args.no_branch:
-        branch = pd.read_csv(cylfile.replace('cyl', 'branch'),
-                             sep='\t',
-                             names=['BOrd', 'BPar', 'BVol', 'BLen', 'BAng', 'BHei', 'BAzi', 'BDia']) 
+    with prof.stage('read'):
+        cyls = read_cyls(cylfile)
+    field = args.field
 
-        branch.set_index(branch.index + 1, inplace=True) # otherwise branches are lablelled from 0
-        branch_ids = branch[(branch.BLen >= args.min_length) & (branch.BDia >= args.min_radius * 2)].index
+    if not args.no_branch and (args.min_length > 0 or args.min_radius > 0):
+        with prof.stage('filter'):
+            keep = filter_branches(read_branches(branch_file(cylfile)), args.min_length, args.min_radius)
+            cyls = cyls[keep.reindex(cyls.branch, fill_value=False).values]
 
     if args.random:
 
-        values = cyls[args.field].unique()
+        values = cyls[field].unique()
         MAP = {V:i for i, V in enumerate(np.random.choice(values, size=len(values), replace=False))}
-        cyls.loc[:, 'COL'] = cyls[args.field].map(MAP)
-        args.field = 'COL'
+        cyls.loc[:, 'COL'] = cyls[field].map(MAP)
+        field = 'COL'
 
     if args.verbose: print(cyls.head())
     
-    pandas2ply(cyls, args.field, cylfile[:-4] + '.ply')
+    pandas2ply(cyls, field, cylfile[:-4] + '.ply', prof=prof)
         
-def pandas2ply(cyls, field, out):
+def rotation_matrices(A, angle):
+    '''returns a rotation matrix per row of A, vectorised rotation_matrix'''
+    c = np.cos(angle)[:, None, None]
+    s = np.sin(angle)[:, None, None]
+    x, y, z = A[:, 0], A[:, 1], A[:, 2]
+    K = np.zeros((len(A), 3, 3))
+    K[:, 0, 1], K[:, 0, 2] = -z, y
+    K[:, 1, 0], K[:, 1, 2] = z, -x
+    K[:, 2, 0], K[:, 2, 1] = -y, x
+    return c * np.eye(3) + s * K + (1 - c) * np.einsum('ni,nj->nij', A, A)
 
-    n = len(cyls)
-    n_vertices = 50 * n
-    n_faces = 96 * n
-    
-    tempvertices = []
-    tempfaces = []
-    
-    add = 0
-    for i, (ix, cyl) in enumerate(cyls.iterrows()):
-
-        nvertex = 48                       # number of vertices, do not change!
-        rad = cyl.radius                   # cylinder radius
-        l = cyl.length                     # cylinder length
-        startp = [cyl.sx, cyl.sy, cyl.sz]  # startpoint
-        axis = [cyl.ax, cyl.ay, cyl.az]    # axis relative to startpoint
-
-        # first the cylinder is created without rotation
-        # starting with center of bottom and top circle
-    
-        p1 = [0.0, 0.0, 0.0]
-        p2 = [0.0, 0.0, l]
-
-        degs = np.deg2rad(np.arange(0, 360, 15))
-        ps = [p1,p2]
-
-        # add vertices on the bottom and top circle
-        for p0 in [p1, p2]:
-            for deg in degs:
-                x0 = rad*math.cos(deg)+p0[0]
-                y0 = rad*math.sin(deg)+p0[1]
-                z0 = p0[2]
-            
-                ps += [[x0,y0,z0]]
+def cylinder_vertices(cyls):
+    '''returns the 50 mesh vertices of every cylinder as an (n, 50, 3) array'''
+    # first the cylinders are created without rotation starting with the
+    # center of the bottom and top circle followed by the two circles
+    degs = np.deg2rad(np.arange(0, 360, 15))
+    template = np.zeros((50, 3))
+    template[1, 2] = 1
+    template[2:, 0] = np.tile(np.cos(degs), 2)
+    template[2:, 1] = np.tile(np.sin(degs), 2)
+    template[26:, 2] = 1
 
-        # the following part is adjusted from script in Matlab that does rotation
-        u = [0,0,1]
-        raxis = [u[1]*axis[2]-axis[1]*u[2],
-                 u[2]*axis[0]-axis[2]*u[0],
-                 u[0]*axis[1]-axis[0]*u[1]]
+    rad = cyls.radius.values
+    scale = np.stack([rad, rad, cyls.length.values], axis=1)
+    ps = template[None, :, :] * scale[:, None, :]
 
-        eucl = (axis[0]**2+axis[1]**2+axis[2]**2)**0.5
-        euclr = (raxis[0]**2+raxis[1]**2+raxis[2]**2)**0.5
+    # rotate z onto the cylinder axis around u x axis
+    axis = cyls[['ax', 'ay', 'az']].values.astype(float)
+    eucl = np.linalg.norm(axis, axis=1)
+    raxis = np.stack([-axis[:, 1], axis[:, 0], np.zeros(len(axis))], axis=1)
+    euclr = np.linalg.norm(raxis, axis=1)
+    # vertical cylinders have no rotation axis, any horizontal axis will do
+    raxis[euclr == 0] = [1, 0, 0]
+    euclr[euclr == 0] = 1
+    raxis /= euclr[:, None]
+    angle = np.arccos(np.clip(axis[:, 2] / eucl, -1, 1))
 
-        for i in range(3):
-            raxis[i] /= euclr
-
-        angle = math.acos(dot(u,axis)/eucl)
+    M = rotation_matrices(raxis, angle)
+    
+    # add start position
+    return np.einsum('nij,nkj->nki', M, ps) + cyls[['sx', 'sy', 'sz']].values[:, None, :]
 
-        M = rotation_matrix(raxis,angle)
+def pandas2ply(cyls, field, out, prof=off):
 
-        for i in range(len(ps)):
-            p = ps[i]
-            x = p[0]*M[0][0]+p[1]*M[0][1]+p[2]*M[0][2]
-            y = p[0]*M[1][0]+p[1]*M[1][1]+p[2]*M[1][2]
-            z = p[0]*M[2][0]+p[1]*M[2][1]+p[2]*M[2][2]
+    fields = [field] if isinstance(field, str) else list(field)
 
-            # add start position
-            x += startp[0]
-            y += startp[1]
-            z += startp[2]
-            ps[i] = [x,y,z, cyl[field]]
+    n = len(cyls)
+    n_vertices = 50 * n
+    n_faces = 96 * n
 
-        tempvertices += ps
-        for row in faces:
-            tempfaces += [[row[0]]+[row[i]+add for i in [1,2,3]]]
+    with prof.stage('build mesh'):
+        vertices = cylinder_vertices(cyls).reshape(-1, 3)
+        values = np.repeat(cyls[fields].values.astype(float), 50, axis=0)
 
-        add += 50
+        F = np.array(faces)
+        tempfaces = np.tile(F, (n, 1))
+        tempfaces[:, 1:] += np.repeat(np.arange(n) * 50, len(F))[:, None]
 
-    header[4] = "element vertex " + str(n_vertices)
-    header[8] = "property float {}".format(field)
-    header[9] = "element face " + str(n_faces)
+    ply_header = header[:8] + ["property float {}".format(f) for f in fields] + header[9:]
+    ply_header[4] = "element vertex " + str(n_vertices)
+    ply_header[-3] = "element face " + str(n_faces)
 
-    with open(out, 'w') as theFile:
-        for i in header:
+    with prof.stage('write'), open(out, 'w') as theFile:
+        for i in ply_header:
             theFile.write(i+'\n')
-        for p in tempvertices:
-            theFile.write(str(p[0])+' '+str(p[1])+' '+str(p[2])+' '+str(p[3])+'\n')
-        for f in tempfaces:
-            #print f
-            theFile.write(str(f[0])+' '+str(f[1])+' '+str(f[2])+' '+str(f[3])+'\n')
+        np.savetxt(theFile, np.hstack([vertices, values]), fmt='%.6f')
+        np.savetxt(theFile, tempfaces, fmt='%i')
+
+    prof.count('cylinders', n)
+    prof.count_bytes(out)
 
 if __name__ == '__main__':
 
@@ -247,10 +272,17 @@ if __name__ == '__main__':
     parser.add_argument('-rc', '--random', default=False, action='store_true', help='randomise colours')
     parser.add_argument('-r', '--min_radius', default=0, type=float, help='filter branhces by minimum radius')
     parser.add_argument('-l', '--min_length', default=0, type=float, help='filter branches by minimum length')
+    parser.add_argument('-p', '--processes', default=1, type=int, help='number of files converted in parallel')
     parser.add_argument('--no_branch', action='store_true', help='use if no corresponding branch file is available')
     parser.add_argument('--verbose', action='store_true', help='print some stuff to screen')
+    add_profile_args(parser)
     args = parser.parse_args()
     
-    for x,line in enumerate(args.cyl):             # loops through treelistfile
-        name = line.split()[0]
-        load_cyls(name, args)
+    names = [line.split()[0] for line in args.cyl]  # loops through treelistfile
+
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            list(pool.map(load_cyls, names, [args] * len(names)))
+    else:
+        for name in names:
+            load_cyls(name, args)
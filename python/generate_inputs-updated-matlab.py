@@ -3,6 +3,9 @@ import sys
 import numpy as np
 import argparse
 
+from instrument import Profiler, add_profile_args, off
+from stage_cloud import stage_cloud
+
 def parse_args():
     
     parser = argparse.ArgumentParser(
@@ -122,11 +125,17 @@ def parse_args():
                         type=int, choices=[0,1,2], default=1,
                         help=('Defines what is displayed during the reconstruction: '
                               '2 = display all; 1 = display name, parameters and distances; 0 = display only the name (default: %(default)s).'))
+    parser.add_argument('--stage_dir',
+                        type=str, default=None,
+                        help=('If set, decode the .ply cloud once into a raw float64 .bin file in this directory (e.g. /dev/shm/treeqsm) '
+                              'which the .m files memory-map with read_bin.m instead of parsing the .ply. '
+                              'Jobs fall back to read_ply.m if the .bin file is missing (default: None).'))
+    add_profile_args(parser)
 
     return parser.parse_args()
 
 
-def generate_inputs(cloud_file, args):
+def generate_inputs(cloud_file, args, prof=off):
     results_dir = args.results_dir
     if results_dir is None:
         results_dir = os.path.abspath(os.getcwd())
@@ -140,7 +149,15 @@ def generate_inputs(cloud_file, args):
     name = os.path.splitext(os.path.basename(cloud_file))[0]
     ftype = os.path.splitext(cloud_file)[1].lower().lstrip('.')
 
+    bin_file = None
+    if args.stage_dir is not None and ftype == 'ply':
+        with prof.stage('stage cloud'):
+            bin_file, n_points = stage_cloud(cloud_file, os.path.abspath(os.path.expanduser(args.stage_dir)))
+        prof.count('points', n_points)
+        print(f"\nCloud staged for memory-mapping ({n_points} points):\n\t{bin_file}")
+
     idx_counter = 1
+    written = set()
 
     for pd1 in args.patchdiam1:
         for pd2min in args.patchdiam2min:
@@ -189,7 +206,20 @@ def generate_inputs(cloud_file, args):
                     # fh.write("input.model = 1;\n")
                     
                     # Load or filter point cloud
-                    if ftype == 'ply':
+                    if ftype == 'ply' and bin_file is not None:
+                        # staged cloud is already filtered to wood points
+                        fh.write(f"if exist('{bin_file}', 'file') == 2\n")
+                        fh.write(f"\tcloud = read_bin('{bin_file}', 3);\n")
+                        fh.write("else\n")
+                        fh.write(f"\tcloud = read_ply('{os.path.abspath(cloud_file)}');\n")
+                        fh.write("\tif size(cloud, 2) == 4\n")
+                        fh.write("\t\tidx = (cloud(:, 4) == 3);\n")
+                        fh.write("\t\tcloud = cloud(idx, 1:3);\n")
+                        fh.write("\telse\n")
+                        fh.write("\t\tcloud = cloud(:, 1:3);\n")
+                        fh.write("\tend\n")
+                        fh.write("end\n")
+                    elif ftype == 'ply':
                         fh.write(f"cloud = read_ply('{os.path.abspath(cloud_file)}');\n")
                         fh.write("if size(cloud, 2) == 4\n")
                         fh.write("\tidx = (cloud(:, 4) == 3);\n")
@@ -217,9 +247,14 @@ def generate_inputs(cloud_file, args):
                     fh.write("disp(['TreeQSM job finished at: ', datestr(now, 31)]);\n")
                     fh.write("disp(['Total elapsed time (seconds): ', num2str(elapsedTime)]);\n")
                     fh.write("exit;\n")
+                written.add(ofn)
 
             idx_counter += 1           
             print(f"\t{ofn}")
+
+    # counted once per file, parameter sets sharing an index overwrite each other
+    prof.count('param_files', len(written))
+    prof.count_bytes(*sorted(written))
         
 
 if __name__ == '__main__':
@@ -249,4 +284,6 @@ if __name__ == '__main__':
     print(f"\nGenerating {n_files} parameter set(s). For each set, {args.n_models} QSM(s) will be generated and saved in:\n\t{args.results_dir}")
     print(f"\nEach file below contains one parameter set:")
     
-    generate_inputs(args.input, args)
+    with Profiler('generate_inputs', args.input, args.profile, args.cprofile) as prof:
+        with prof.stage('write params'):
+            generate_inputs(args.input, args, prof=prof)
@@ -0,0 +1,101 @@
+"""
+Timing and memory instrumentation shared by the command line tools.
+
+Profiling is switched on with --profile [PATH] or by setting TREEQSM_PROFILE
+(to 1 for stderr or to a file path). One JSON line is written per input file
+with the time spent in each named stage, the tracemalloc peak and counters
+such as points, cylinders or bytes written. --cprofile DIR (or
+TREEQSM_CPROFILE) also dumps cProfile stats per input file, readable with
+python -m pstats or snakeviz.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+def add_profile_args(parser):
+
+    parser.add_argument('--profile', nargs='?', const='-', default=os.environ.get('TREEQSM_PROFILE'),
+                        help=('Write a JSON line per input file with stage timings, peak memory and counters '
+                              'to PROFILE (default: stderr). Also set by the TREEQSM_PROFILE environment variable'))
+    parser.add_argument('--cprofile', default=os.environ.get('TREEQSM_CPROFILE'),
+                        help=('Directory to dump cProfile stats per input file. '
+                              'Also set by the TREEQSM_CPROFILE environment variable'))
+
+class Profiler:
+
+    def __init__(self, script, fp, profile=None, cprofile=None):
+
+        self.enabled = profile not in [None, '', '0']
+        self.record = {'script':script, 'input':fp, 'stages':{}, 'counters':{}}
+        self.profile = '-' if profile == '1' else profile
+        self.cprofile = cprofile or None
+
+    def __enter__(self):
+
+        if self.enabled:
+            self.start = time.perf_counter()
+            tracemalloc.start()
+        if self.cprofile:
+            self.pr = cProfile.Profile()
+            self.pr.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+
+        if self.cprofile:
+            self.pr.disable()
+            os.makedirs(self.cprofile, exist_ok=True)
+            name = os.path.splitext(os.path.basename(self.record['input']))[0]
+            self.pr.dump_stats(os.path.join(self.cprofile, '{}.{}.prof'.format(self.record['script'], name)))
+
+        if self.enabled:
+            self.record['wall'] = round(time.perf_counter() - self.start, 6)
+            self.record['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+            tracemalloc.stop()
+            if exc is not None:
+                self.record['error'] = '{}: {}'.format(exc_type.__name__, exc)
+            self.write()
+
+        return False
+
+    def write(self):
+
+        line = json.dumps(self.record) + '\n'
+        if self.profile == '-':
+            sys.stderr.write(line)
+        else:
+            # a single append keeps lines from parallel workers intact
+            with open(self.profile, 'a') as fh:
+                fh.write(line)
+
+    def stage(self, name):
+
+        if not self.enabled: return nullcontext()
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record['stages'][name] = round(self.record['stages'].get(name, 0) + time.perf_counter() - t, 6)
+
+    def count(self, key, n):
+
+        if self.enabled:
+            self.record['counters'][key] = self.record['counters'].get(key, 0) + int(n)
+
+    def count_bytes(self, *paths):
+
+        for path in paths:
+            if os.path.isfile(path): self.count('bytes_written', os.path.getsize(path))
+
+# used when a function is called without a profiler
+off = Profiler(None, None)
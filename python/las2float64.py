@@ -0,0 +1,209 @@
+import argparse
+import os
+import struct
+import numpy as np
+
+from ply2float64 import write_ply_header, patch_vertex_count
+
+# read_ply.m passes the label property on and the .m files written by
+# generate_inputs keep label == 3, so a label field is mapped to this value
+# rather than written as is (e.g. ASPRS class 3 is low vegetation)
+WOOD = 3
+
+# fields common to point data record formats 0-5 and 6-10
+legacy_fields = [('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('intensity', '<u2'),
+                 ('return_bits', 'u1'), ('class_bits', 'u1'), ('scan_angle_rank', 'i1'),
+                 ('user_data', 'u1'), ('point_source_id', '<u2')]
+
+extended_fields = [('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('intensity', '<u2'),
+                   ('return_bits', 'u1'), ('flag_bits', 'u1'), ('classification', 'u1'),
+                   ('user_data', 'u1'), ('scan_angle', '<i2'), ('point_source_id', '<u2'),
+                   ('gps_time', '<f8')]
+
+gps = [('gps_time', '<f8')]
+rgb = [('red', '<u2'), ('green', '<u2'), ('blue', '<u2')]
+nir = [('nir', '<u2')]
+wave = [('wave_packet', 'u1'), ('wave_offset', '<u8'), ('wave_size', '<u4'),
+        ('wave_location', '<f4'), ('wave_x', '<f4'), ('wave_y', '<f4'), ('wave_z', '<f4')]
+
+point_formats = {0: legacy_fields,
+                 1: legacy_fields + gps,
+                 2: legacy_fields + rgb,
+                 3: legacy_fields + gps + rgb,
+                 4: legacy_fields + gps + wave,
+                 5: legacy_fields + gps + rgb + wave,
+                 6: extended_fields,
+                 7: extended_fields + rgb,
+                 8: extended_fields + rgb + nir,
+                 9: extended_fields + wave,
+                 10: extended_fields + rgb + nir + wave}
+
+def read_las_header(fp):
+
+    with open(fp, 'rb') as las:
+        raw = las.read(375)
+
+    if raw[:4] != b'LASF':
+        raise ValueError('{} is not a LAS file'.format(fp))
+
+    header = {}
+    header['version'] = (raw[24], raw[25])
+    header['header_size'], header['offset'] = struct.unpack('<HI', raw[94:100])
+    header['point_format'], header['record_length'] = struct.unpack('<BH', raw[104:107])
+    header['n'] = struct.unpack('<I', raw[107:111])[0]
+    header['scale'] = np.array(struct.unpack('<3d', raw[131:155]))
+    header['translate'] = np.array(struct.unpack('<3d', raw[155:179]))
+    maxx, minx, maxy, miny, maxz, minz = struct.unpack('<6d', raw[179:227])
+    header['min'] = np.array([minx, miny, minz])
+    header['max'] = np.array([maxx, maxy, maxz])
+
+    # LAS 1.4 moves the point count to a 64-bit field, the legacy count is 0
+    # for formats 6-10 or files with more than 2^32 points
+    if header['version'] >= (1, 4) and header['header_size'] >= 375:
+        n = struct.unpack('<Q', raw[247:255])[0]
+        if n > 0: header['n'] = n
+
+    if header['point_format'] & 0xC0:
+        raise Exception('{} appears to be compressed (LAZ)'.format(fp))
+    if header['point_format'] not in point_formats:
+        raise ValueError('unsupported point data record format {}'.format(header['point_format']))
+
+    return header
+
+def las_dtype(point_format, record_length):
+
+    fields = point_formats[point_format]
+    dt = np.dtype(fields)
+    if record_length < dt.itemsize:
+        raise ValueError('record length {} is shorter than format {} ({} bytes)'.format(
+                         record_length, point_format, dt.itemsize))
+
+    # extra bytes are skipped by padding the record to record_length
+    return np.dtype({'names':dt.names,
+                     'formats':[dt.fields[f][0] for f in dt.names],
+                     'offsets':[dt.fields[f][1] for f in dt.names],
+                     'itemsize':record_length})
+
+def read_las(fp):
+
+    """
+    returns the header and a read-only memory map of the point records,
+    nothing is read from disk until the records are accessed
+    """
+
+    header = read_las_header(fp)
+    dtype = las_dtype(header['point_format'], header['record_length'])
+    points = np.memmap(fp, dtype=dtype, mode='r', offset=header['offset'], shape=(header['n'],))
+
+    return header, points
+
+def get_field(chunk, field, point_format):
+
+    # classification shares a byte with the synthetic/keypoint/withheld flags
+    # in formats 0-5
+    if field == 'classification' and point_format < 6:
+        return chunk['class_bits'] & 0x1F
+    return chunk[field]
+
+def las2ply(fp, output_name, field='classification', values=None, label=None, wood=None,
+            chunk_size=2**22, verbose=False):
+
+    if label is not None and wood is None:
+        raise ValueError('label requires the values of {} that are wood'.format(label))
+
+    header, points = read_las(fp)
+    pf = header['point_format']
+
+    properties = [('float64', 'x'), ('float64', 'y'), ('float64', 'z')]
+    out_dtype = [('x', '<f8'), ('y', '<f8'), ('z', '<f8')]
+    if label is not None:
+        properties += [('float64', 'label')]
+        out_dtype += [('label', '<f8')]
+
+    comments = ['converted from {}'.format(os.path.basename(fp))]
+    if values is not None:
+        comments += ['{} in {}'.format(field, ' '.join(str(v) for v in values))]
+    if label is not None:
+        comments += ['label {} where {} in {}'.format(WOOD, label, ' '.join(str(v) for v in wood))]
+
+    pad = len(str(header['n']))
+    N = 0
+
+    with open(output_name, 'w') as ply:
+        write_ply_header(ply, 0, properties, comments=comments, obj_info='las2float64.py', pad=pad)
+
+    with open(output_name, 'ab') as ply:
+        for i in range(0, header['n'], chunk_size):
+
+            chunk = points[i:i + chunk_size]
+            if values is not None:
+                chunk = chunk[np.isin(get_field(chunk, field, pf), values)]
+
+            out = np.empty(len(chunk), dtype=out_dtype)
+            for j, (c, C) in enumerate(zip('xyz', 'XYZ')):
+                out[c] = chunk[C] * header['scale'][j] + header['translate'][j]
+            if label is not None:
+                out['label'] = np.where(np.isin(get_field(chunk, label, pf), wood), WOOD, 0)
+
+            ply.write(out.tobytes())
+            N += len(out)
+
+            if verbose: print('\t{} of {} points read'.format(min(i + chunk_size, header['n']), header['n']))
+
+    patch_vertex_count(output_name, N, pad)
+
+    return N
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert LAS 1.2-1.4 file(s) to float64 PLY readable by read_ply.m')
+    parser.add_argument('-i', '--input', type=str, nargs='+', required=True,
+                        help='Path to one or more .las files')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help=("Path to save converted PLY file, or a directory when several inputs are given; "
+                              "default is current directory with suffix '_float64.ply'"))
+    parser.add_argument('-c', '--classification', type=int, nargs='+', default=None,
+                        help='keep only points with these classification values')
+    parser.add_argument('-f', '--field', type=str, default=None,
+                        help='filter on this point field instead of classification e.g. user_data or point_source_id')
+    parser.add_argument('-v', '--values', type=int, nargs='+', default=None,
+                        help='values of --field to keep')
+    parser.add_argument('-l', '--label', type=str, default=None,
+                        help=('point field used to write the label property read by the .m files, '
+                              'requires --wood e.g. -l classification -w 4 5'))
+    parser.add_argument('-w', '--wood', type=int, nargs='+', default=None,
+                        help=f'values of --label that are wood, written as label {WOOD} (all other points as 0)')
+    parser.add_argument('--chunk_size', type=int, default=2**22,
+                        help='number of points converted at a time (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help='print some stuff to screen')
+    args = parser.parse_args()
+
+    if args.field is not None and args.values is None:
+        parser.error('--field requires --values')
+    if args.label is not None and args.wood is None:
+        parser.error('--label requires --wood')
+
+    if args.field is not None:
+        field, values = args.field, args.values
+    else:
+        field, values = 'classification', args.classification
+
+    for las in args.input:
+
+        if not las.lower().endswith('.las'):
+            raise ValueError("The input file must be a .las file")
+
+        name = os.path.splitext(os.path.basename(las))[0] + '_float64.ply'
+        if args.output is None:
+            output_path = os.path.join(os.getcwd(), name)
+        elif os.path.isdir(args.output) or len(args.input) > 1:
+            os.makedirs(args.output, exist_ok=True)
+            output_path = os.path.join(os.path.abspath(args.output), name)
+        else:
+            output_path = os.path.abspath(args.output)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        print(f"\nConverting: \n{os.path.abspath(las)}\n")
+        N = las2ply(las, output_path, field=field, values=values, label=args.label,
+                    wood=args.wood, chunk_size=args.chunk_size, verbose=args.verbose)
+        print(f"Saved {N} points to: \n{output_path}\n")
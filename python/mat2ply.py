@@ -3,74 +3,134 @@
 import sys
 import os
 import argparse
+import traceback
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 from cyl2ply import pandas2ply
 from mat2qsm import QSM
+from instrument import Profiler, add_profile_args
 
-parser = argparse.ArgumentParser(description='Convert .mat files to .ply format.')
-parser.add_argument('-i', '--input_mat_files', nargs='+', required=True, 
-                    help='One or multiple .mat files to process')
-parser.add_argument('-o', '--output', default=None, 
-                    help=(
-                        'Output directory or full path output filename. ' 
-                        'If a dir is given, output will have the same filename as input with .ply extension. '
-                        'If a filename is given, it will be used directly. '
-                        'Default: current directory with same filename.'))
-args = parser.parse_args()
+cyl_fields = ['branch', 'BranchOrder', 'PositionInBranch', 'radius']
+branch_fields = ['BVol', 'BAng']
 
-for mat in args.input_mat_files:
+def output_paths(mat, output):
+
+    input_filename = os.path.basename(mat)
+    default_outdir = os.getcwd()
+    default_basename = os.path.splitext(input_filename)[0] + '.ply'
+
+    if output is None:
+        out_ply = os.path.join(default_outdir, default_basename)
+        out_tri_ply = os.path.join(default_outdir, os.path.splitext(input_filename)[0] + '_tri.ply')
+    # If -o is a directory, use the default basename
+    elif os.path.isdir(output):
+        out_ply = os.path.join(output, default_basename)
+        out_tri_ply = os.path.join(output, os.path.splitext(input_filename)[0] + '_tri.ply')
+    # If -o is a file, use it as output filename
+    else:
+        out_ply = output
+        base, ext = os.path.splitext(output)
+        out_tri_ply = base + '_tri.ply'
+
+    return out_ply, out_tri_ply
+
+def up_to_date(mat, out_ply):
+
+    return os.path.isfile(out_ply) and os.path.getmtime(out_ply) >= os.path.getmtime(mat)
+
+def qsm2pd(qsm, fields):
+
+    cyls = qsm.cyl2pd()
+    join = [f for f in fields if f not in cyls.columns]
+    if len(join) > 0:
+        # branch attributes are joined onto every cylinder of the branch
+        cyls = cyls.join(qsm.branch2pd()[join], on='branch')
+
+    return cyls[['length', 'radius', 'sx', 'sy', 'sz', 'ax', 'ay', 'az'] +
+                [f for f in fields if f not in ['length', 'radius']]]
+
+def mat2ply(mat, args):
+
+    out_ply, out_tri_ply = output_paths(mat, args.output)
+
+    if not args.overwrite and up_to_date(mat, out_ply):
+        print('skipping (up to date):', mat)
+        return True
 
     print('processing:', mat)
 
-    try: 
-        qsm = QSM(mat)
-        
-        input_filename = os.path.basename(mat)
-        default_outdir = os.getcwd()
-        default_basename = os.path.splitext(input_filename)[0] + '.ply'
-
-        if args.output is None:
-            out_ply = os.path.join(default_outdir, default_basename)
-        # If -o is a directory, use the default basename
-        elif os.path.isdir(args.output):
-            out_ply = os.path.join(args.output, default_basename)
-        # If -o is a file, use it as output filename
-        else:
-            out_ply = args.output
-
-        pandas2ply(qsm.cyl2pd()[['length', 'radius', 'sx', 'sy', 'sz', 'ax', 'ay', 'az', 'branch']], 
-                   'branch', 
-                   out_ply) 
-        
-        if qsm.Tria == 1:
-            
-            threes = np.ones((len(qsm.tri_facet), 1)) + 2
-            facets = np.hstack([threes, qsm.tri_facet])
-            
-            if args.output is None:
-                out_tri_ply = os.path.join(default_outdir, os.path.splitext(input_filename)[0] + '_tri.ply')
-            elif os.path.isdir(args.output):
-                out_tri_ply = os.path.join(args.output, os.path.splitext(input_filename)[0] + '_tri.ply')
-            else:
-                base, ext = os.path.splitext(args.output)
-                out_tri_ply = base + '_tri.ply'
-            with open(out_tri_ply, 'w') as ply:
-                
-                ply.write("ply\n")
-                ply.write("format ascii 1.0\n")
-                ply.write("comment Author: Phil Wilkes\n")
-                ply.write("obj_info Generated using Python\n")
-                ply.write("element vertex {}\n".format(len(qsm.tri_vert)))
-                ply.write("property float x\n")
-                ply.write("property float y\n")
-                ply.write("property float z\n")
-                ply.write("element face {}\n".format(len(facets)))
-                ply.write("property list uchar int vertex_indices\n")
-                ply.write("end_header\n")
-                
-                np.savetxt(ply, qsm.tri_vert, fmt='%.3f')
-                np.savetxt(ply, facets, fmt='%.i')
-
-    except Exception as err:
-        print(err)
+    try:
+        with Profiler('mat2ply', mat, args.profile, args.cprofile) as prof:
+
+            with prof.stage('read mat'):
+                qsm = QSM(mat)
+
+            with prof.stage('build table'):
+                cyls = qsm2pd(qsm, args.fields)
+
+            pandas2ply(cyls, args.fields, out_ply, prof=prof)
+
+            # QSM 2.0 files have no triangulation
+            if getattr(qsm, 'Tria', 0) == 1:
+
+                threes = np.ones((len(qsm.tri_facet), 1)) + 2
+                facets = np.hstack([threes, qsm.tri_facet])
+
+                with prof.stage('write triangulation'), open(out_tri_ply, 'w') as ply:
+
+                    ply.write("ply\n")
+                    ply.write("format ascii 1.0\n")
+                    ply.write("comment Author: Phil Wilkes\n")
+                    ply.write("obj_info Generated using Python\n")
+                    ply.write("element vertex {}\n".format(len(qsm.tri_vert)))
+                    ply.write("property float x\n")
+                    ply.write("property float y\n")
+                    ply.write("property float z\n")
+                    ply.write("element face {}\n".format(len(facets)))
+                    ply.write("property list uchar int vertex_indices\n")
+                    ply.write("end_header\n")
+
+                    np.savetxt(ply, qsm.tri_vert, fmt='%.3f')
+                    np.savetxt(ply, facets, fmt='%.i')
+
+                prof.count_bytes(out_tri_ply)
+
+    except Exception:
+        print('failed:', mat, file=sys.stderr)
+        traceback.print_exc()
+        return False
+
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert .mat files to .ply format.')
+    parser.add_argument('-i', '--input_mat_files', nargs='+', required=True,
+                        help='One or multiple .mat files to process')
+    parser.add_argument('-o', '--output', default=None,
+                        help=(
+                            'Output directory or full path output filename. '
+                            'If a dir is given, output will have the same filename as input with .ply extension. '
+                            'If a filename is given, it will be used directly. '
+                            'Default: current directory with same filename.'))
+    parser.add_argument('-f', '--fields', nargs='+', default=cyl_fields + branch_fields,
+                        help=('Cylinder (e.g. BranchOrder, UnmodRadius) and branch (e.g. BOrd, BVol, BLen, BAng) '
+                              'attributes written as vertex properties. Default: %(default)s'))
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of .mat files converted in parallel (default: %(default)s)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Convert even if the .ply is newer than the .mat file')
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            done = list(pool.map(mat2ply, args.input_mat_files, [args] * len(args.input_mat_files)))
+    else:
+        done = [mat2ply(mat, args) for mat in args.input_mat_files]
+
+    if not all(done):
+        print('{} of {} files failed'.format(done.count(False), len(done)), file=sys.stderr)
+        sys.exit(1)
@@ -1,3 +1,4 @@
+import os
 import sys
 import scipy.io
 import pandas as pd
@@ -160,9 +161,17 @@ class QSM:
             
 
 if __name__ == "__main__":
-   
+
+    from instrument import Profiler
+
+    # profiling is only set through TREEQSM_PROFILE/TREEQSM_CPROFILE as the
+    # arguments are all .mat files
     for path2mat in sys.argv[1:]:
        
-        qsm = QSM(path2mat)
+        with Profiler('mat2qsm', path2mat, os.environ.get('TREEQSM_PROFILE'), 
+                      os.environ.get('TREEQSM_CPROFILE')) as prof:
+            with prof.stage('read mat'):
+                qsm = QSM(path2mat)
+            prof.count('cylinders', len(qsm.cyl_radius))
         print('{}: {} {}'.format(path2mat, qsm.TotalVolume, qsm.PatchDiam1))
         #print '{}: {}'.format(path2mat, qsm.TotalVolume)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+Watch-folder pipeline running every tree through the steps of the README
+as soon as its inputs appear, instead of one step for all trees at a time:
+
+    clouds/*.ply|*.las  -> clouds/float64/TREE.ply            (ply2float64 / las2float64)
+                        -> models/params/TREE/TREE_param_*.m  (generate_inputs-updated-matlab.py)
+                        -> models/qsm_candidates/TREE/*.mat   (TreeQSM, --matlab_cmd)
+                        -> models/optqsm/*.mat                (optqsm, --optqsm_cmd)
+                        -> models/optqsm/*.ply                (mat2ply)
+
+Candidate directories appearing in qsm_candidates/ and models appearing in
+optqsm/ (e.g. produced on another machine) are picked up as well. Every
+stage has its own concurrency limit, and finished outputs are skipped so the
+pipeline can be stopped and restarted.
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import shlex
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+MATLAB_CMD = "matlab -nodisplay -nosplash -r \"run('{m}'); exit;\""
+OPTQSM_CMD = ("matlab -nodisplay -r \"addpath(genpath('{treeqsm_src}')); addpath('{optqsm_src}'); "
+              "runopt('{candidates}/*.mat'); exit;\"")
+
+def up_to_date(src, dst):
+
+    return os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+def convert_cloud(src, dst):
+
+    if src.lower().endswith('.las'):
+        from las2float64 import las2ply
+        las2ply(src, dst)
+    else:
+        from ply2float64 import read_ply, write_ply
+        write_ply(dst, read_ply(src))
+
+def export_mat(mat, odir):
+
+    from mat2ply import mat2ply, cyl_fields, branch_fields
+    args = argparse.Namespace(output=odir, fields=cyl_fields + branch_fields, overwrite=False,
+                              profile=os.environ.get('TREEQSM_PROFILE'), cprofile=os.environ.get('TREEQSM_CPROFILE'))
+    return mat2ply(mat, args)
+
+def expected_models(m):
+
+    # number of models per parameter set, see the for loop written by generate_inputs
+    with open(m) as fh:
+        match = re.search(r'for\s+i\s*=\s*1:(\d+)', fh.read())
+    return int(match.group(1)) if match else 1
+
+def log(tree, msg):
+
+    print('[{}] {}: {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), tree, msg), flush=True)
+
+class Pipeline:
+
+    def __init__(self, args):
+
+        self.args = args
+        root = os.path.abspath(args.root)
+        self.clouds_dir = os.path.join(root, 'clouds')
+        self.float64_dir = os.path.join(self.clouds_dir, 'float64')
+        self.params_dir = os.path.join(root, 'models', 'params')
+        self.candidates_dir = os.path.join(root, 'models', 'qsm_candidates')
+        self.optqsm_dir = os.path.join(root, 'models', 'optqsm')
+        for d in [self.clouds_dir, self.float64_dir, self.params_dir, self.candidates_dir, self.optqsm_dir]:
+            os.makedirs(d, exist_ok=True)
+
+        self.limits = {'convert':asyncio.Semaphore(args.convert_jobs),
+                       'params':asyncio.Semaphore(args.convert_jobs),
+                       'treeqsm':asyncio.Semaphore(args.treeqsm_jobs),
+                       'optqsm':asyncio.Semaphore(args.optqsm_jobs),
+                       'export':asyncio.Semaphore(args.export_jobs)}
+        self.pool = ProcessPoolExecutor(max_workers=max(args.convert_jobs, args.export_jobs))
+
+        self.active = set()  # trees with a running task
+        self.seen = set()    # files already handed to a task
+        self.sizes = {}      # file sizes of the last poll
+        self.tasks = set()
+        self.failed = 0
+
+    def stable(self, fp):
+
+        # a file is used once its size has not changed between two polls
+        size = os.path.getsize(fp)
+        last, self.sizes[fp] = self.sizes.get(fp), size
+        return size == last
+
+    def start(self, coro):
+
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_cmd(self, cmd, logfile, cwd=None):
+
+        with open(logfile, 'w') as fh:
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=fh, stderr=asyncio.subprocess.STDOUT, cwd=cwd)
+            return await proc.wait()
+
+    async def in_pool(self, func, *args):
+
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    ## stages
+
+    async def convert(self, tree, cloud):
+
+        dst = os.path.join(self.float64_dir, tree + '.ply')
+        if up_to_date(cloud, dst): return dst
+
+        async with self.limits['convert']:
+            log(tree, 'converting ' + cloud)
+            await self.in_pool(convert_cloud, cloud, dst)
+        return dst
+
+    async def make_params(self, tree, cloud):
+
+        pdir = os.path.join(self.params_dir, tree)
+        existing = sorted(glob.glob(os.path.join(pdir, tree + '_param_*.m')))
+        if existing and min(os.path.getmtime(m) for m in existing) >= os.path.getmtime(cloud):
+            return existing
+
+        os.makedirs(pdir, exist_ok=True)
+        cmd = ' '.join([shlex.quote(sys.executable),
+                        shlex.quote(os.path.join(SCRIPT_DIR, 'generate_inputs-updated-matlab.py')),
+                        '-i', shlex.quote(cloud), '-o', shlex.quote(os.path.join(pdir, tree + '_param')),
+                        '-rdir', shlex.quote(os.path.join(self.candidates_dir, tree)), self.args.param_args])
+        async with self.limits['params']:
+            log(tree, 'generating parameter files')
+            if await self.run_cmd(cmd, os.path.join(pdir, tree + '_params.log')) != 0:
+                raise RuntimeError('generate_inputs failed, see ' + os.path.join(pdir, tree + '_params.log'))
+
+        return sorted(glob.glob(os.path.join(pdir, tree + '_param_*.m')))
+
+    async def treeqsm(self, tree, m):
+
+        # e.g. TREE_param_2.m -> TREE-2-*.mat as named by generate_inputs
+        idx = os.path.splitext(m)[0].rsplit('_', 1)[1]
+        pattern = os.path.join(self.candidates_dir, tree, '{}-{}-*.mat'.format(tree, idx))
+        expected = expected_models(m)
+        if len(glob.glob(pattern)) >= expected:
+            return
+
+        logfile = os.path.splitext(m)[0] + '.log'
+        async with self.limits['treeqsm']:
+            log(tree, 'running ' + os.path.basename(m))
+            status = await self.run_cmd(self.args.matlab_cmd.format(m=m), logfile)
+
+        # the .m files catch errors per model, so the exit status alone does not tell
+        found = len(glob.glob(pattern))
+        if status != 0 or found < expected:
+            raise RuntimeError('{} wrote {} of {} models (exit status {}), see {}'.format(
+                               os.path.basename(m), found, expected, status, logfile))
+
+    async def optqsm(self, tree):
+
+        candidates = os.path.join(self.candidates_dir, tree)
+        mats = glob.glob(os.path.join(candidates, '*.mat'))
+        logfile = os.path.join(self.optqsm_dir, tree + '_opt.log')
+        if len(mats) == 0:
+            log(tree, 'no candidate models, skipping optqsm')
+            return
+        if os.path.isfile(logfile) and os.path.getmtime(logfile) >= max(os.path.getmtime(m) for m in mats):
+            return
+        if self.args.optqsm_src is None:
+            log(tree, 'no --optqsm_src given, skipping optqsm')
+            return
+
+        cmd = self.args.optqsm_cmd.format(treeqsm_src=self.args.treeqsm_src, optqsm_src=self.args.optqsm_src,
+                                          candidates=candidates)
+        async with self.limits['optqsm']:
+            log(tree, 'running optqsm on {} candidates'.format(len(mats)))
+            await self.run_cmd(cmd, logfile, cwd=self.optqsm_dir)
+
+    async def export(self, mat):
+
+        name = os.path.splitext(os.path.basename(mat))[0]
+        async with self.limits['export']:
+            log(name, 'exporting ' + os.path.basename(mat))
+            if not await self.in_pool(export_mat, mat, self.optqsm_dir):
+                self.failed += 1
+
+    ## per tree chains
+
+    async def tree_from_cloud(self, tree, cloud):
+
+        try:
+            cloud = await self.convert(tree, cloud)
+            ms = await self.make_params(tree, cloud)
+            # wait for all runs of the tree before reporting the first failure
+            for result in await asyncio.gather(*[self.treeqsm(tree, m) for m in ms], return_exceptions=True):
+                if isinstance(result, Exception): raise result
+            await self.optqsm(tree)
+            log(tree, 'done')
+        except Exception as err:
+            self.failed += 1
+            log(tree, 'failed: {}'.format(err))
+        finally:
+            self.active.discard(tree)
+
+    async def tree_from_candidates(self, tree):
+
+        try:
+            await self.optqsm(tree)
+        except Exception as err:
+            self.failed += 1
+            log(tree, 'failed: {}'.format(err))
+        finally:
+            self.active.discard(tree)
+
+    ## watchers
+
+    def poll(self):
+
+        # files can disappear between glob and stat (partial uploads, rsync
+        # temporary files, clean-ups), such a file is skipped for this poll
+        for cloud in sorted(glob.glob(os.path.join(self.clouds_dir, '*.ply')) + glob.glob(os.path.join(self.clouds_dir, '*.las'))):
+            tree = os.path.splitext(os.path.basename(cloud))[0]
+            try:
+                if cloud in self.seen or tree in self.active or not self.stable(cloud): continue
+            except OSError:
+                continue
+            self.seen.add(cloud)
+            self.seen.add(os.path.join(self.candidates_dir, tree, ''))
+            self.active.add(tree)
+            self.start(self.tree_from_cloud(tree, cloud))
+
+        # candidates produced outside the pipeline, used once no model was added for --settle seconds
+        for d in sorted(glob.glob(os.path.join(self.candidates_dir, '*', ''))):
+            tree = os.path.basename(os.path.dirname(d))
+            mats = glob.glob(os.path.join(d, '*.mat'))
+            if d in self.seen or tree in self.active or len(mats) == 0: continue
+            try:
+                if time.time() - max(os.path.getmtime(m) for m in mats) < self.args.settle: continue
+            except OSError:
+                continue
+            self.seen.add(d)
+            self.active.add(tree)
+            self.start(self.tree_from_candidates(tree))
+
+        for mat in sorted(glob.glob(os.path.join(self.optqsm_dir, '*.mat'))):
+            try:
+                if mat in self.seen or not self.stable(mat): continue
+            except OSError:
+                continue
+            self.seen.add(mat)
+            self.start(self.export(mat))
+
+    async def run(self):
+
+        while True:
+            self.poll()
+            if self.args.once and len(self.tasks) == 0:
+                # nothing running, one more poll picks up models written by the last tasks
+                self.poll()
+                if len(self.tasks) == 0: break
+            await asyncio.sleep(self.args.poll)
+
+        self.pool.shutdown()
+        return self.failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=('Watch DATA/clouds, DATA/models/qsm_candidates and DATA/models/optqsm '
+                                                  'and run each tree through the next step as soon as its inputs appear.'))
+    parser.add_argument('-r', '--root', default=os.getcwd(),
+                        help='DATA directory laid out as in the README (default: current directory)')
+    parser.add_argument('--param_args', default='',
+                        help=('Arguments passed to generate_inputs-updated-matlab.py, '
+                              'e.g. "--patchdiam1 0.2 0.25 0.3 -n 3"'))
+    parser.add_argument('--matlab_cmd', default=MATLAB_CMD,
+                        help='Command running one TreeQSM .m file, {m} is replaced by its path (default: %(default)s)')
+    parser.add_argument('--optqsm_cmd', default=OPTQSM_CMD,
+                        help=('Command selecting the optimum QSM of one tree, run in models/optqsm. {treeqsm_src}, '
+                              '{optqsm_src} and {candidates} are replaced (default: %(default)s)'))
+    parser.add_argument('--treeqsm_src', default=os.path.abspath(os.path.join(SCRIPT_DIR, '..', 'src')),
+                        help="Path to TreeQSM source code (default: '%(default)s')")
+    parser.add_argument('--optqsm_src', default=None,
+                        help='Path to optqsm source code, the optqsm step is skipped if not given')
+    parser.add_argument('--convert_jobs', type=int, default=2,
+                        help='Concurrent cloud conversions and parameter file generations (default: %(default)s)')
+    parser.add_argument('--treeqsm_jobs', type=int, default=3,
+                        help='Concurrent TreeQSM MATLAB processes (default: %(default)s)')
+    parser.add_argument('--optqsm_jobs', type=int, default=1,
+                        help='Concurrent optqsm MATLAB processes (default: %(default)s)')
+    parser.add_argument('--export_jobs', type=int, default=2,
+                        help='Concurrent .mat to .ply exports (default: %(default)s)')
+    parser.add_argument('--poll', type=float, default=10,
+                        help='Seconds between scans of the watched directories (default: %(default)s)')
+    parser.add_argument('--settle', type=float, default=60,
+                        help=('Seconds without new candidate models before a qsm_candidates directory '
+                              'not created by the pipeline is passed to optqsm (default: %(default)s)'))
+    parser.add_argument('--once', action='store_true',
+                        help='Exit once all files present have been processed instead of watching')
+    args = parser.parse_args()
+
+    async def main():
+        return await Pipeline(args).run()
+
+    sys.exit(1 if asyncio.run(main()) else 0)
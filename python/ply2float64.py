@@ -5,6 +5,11 @@ import numpy as np
 import sys
 from glob import glob
 
+from instrument import Profiler, add_profile_args, off
+
+dtype_map = {'uint16':'uint16', 'uint8':'uint8', 'double':'d', 'float64':'f8', 
+             'float32':'f4', 'float': 'f4', 'uchar': 'B', 'int':'i', 'int32':'i'}
+
 def get_ply_files(input_path):
     if os.path.isdir(input_path):
         return glob(os.path.join(input_path, '*.ply'))
@@ -20,80 +25,127 @@ def open_ply(fp, newline=None):
     else:
         return open(fp)
 
-def read_ply(fp):
+def read_ply(fp, prof=off):
 
     line = open_ply(fp).readline()
     newline = '\n' if line == 'ply\n' else None
 
-    return read_ply_(fp, newline)
+    return read_ply_(fp, newline, prof=prof)
     
-def read_ply_(fp, newline):
+def read_ply_(fp, newline, prof=off):
 
     with open_ply(fp, newline=newline) as ply:
  
         length = 0
         prop = []
-        dtype_map = {'uint16':'uint16', 'uint8':'uint8', 'double':'d', 'float64':'f8', 
-                     'float32':'f4', 'float': 'f4', 'uchar': 'B', 'int':'i', 'int32':'i'}
         dtype = []
         fmt = 'binary'
 
-        for i, line in enumerate(ply.readlines()):
+        with prof.stage('read header'):
+            for i, line in enumerate(ply.readlines()):
+                length += len(line)
+                if i == 1:
+                    if 'ascii' in line:
+                        fmt = 'ascii' 
+                if 'element vertex' in line: N = int(line.split()[2])
+                if 'property' in line: 
+                    dtype.append(dtype_map[line.split()[1]])
+                    prop.append(line.split()[2])
+                if 'element face' in line:
+                    raise Exception('.ply appears to be a mesh')
+                if 'end_header' in line: break
+    
+        ply.seek(length)
+
+        with prof.stage('decode body'):
+            if fmt == 'binary':
+                arr = np.fromfile(ply, dtype=','.join(dtype))
+            else:
+                arr = np.loadtxt(ply)
+            df = pd.DataFrame(data=arr)
+            df.columns = prop
+        prof.count('points', len(df))
+
+    return df
+
+def read_ply_header(fp):
+
+    """
+    returns the number of vertices, the vertex dtype, the format and the
+    header length in bytes without reading the body
+    """
+
+    with open(fp, 'rb') as ply:
+
+        length = 0
+        names, formats = [], []
+        fmt = 'binary'
+        endian = '<'
+
+        for line in ply:
             length += len(line)
-            if i == 1:
-                if 'ascii' in line:
-                    fmt = 'ascii' 
+            line = line.decode('ISO-8859-1')
+            if line.startswith('format'):
+                if 'ascii' in line: fmt = 'ascii'
+                if 'big_endian' in line: endian = '>'
             if 'element vertex' in line: N = int(line.split()[2])
-            if 'property' in line: 
-                dtype.append(dtype_map[line.split()[1]])
-                prop.append(line.split()[2])
+            if line.startswith('property'):
+                formats.append(endian + np.dtype(dtype_map[line.split()[1]]).str[1:])
+                names.append(line.split()[2])
             if 'element face' in line:
                 raise Exception('.ply appears to be a mesh')
             if 'end_header' in line: break
-    
-        ply.seek(length)
 
-        if fmt == 'binary':
-            arr = np.fromfile(ply, dtype=','.join(dtype))
-        else:
-            arr = np.loadtxt(ply)
-        df = pd.DataFrame(data=arr)
-        df.columns = prop
+    return N, np.dtype({'names':names, 'formats':formats}), fmt, length
 
-    return df
+def write_ply_header(ply, n, properties, comments=[], obj_info='pcd2ply.py', pad=0):
+
+    """
+    properties is a list of (type, name) tuples. If pad > 0 the vertex count 
+    is zero-padded to that width so it can be patched in place once the 
+    number of points written is known (see patch_vertex_count)
+    """
+
+    ply.write("ply\n")
+    ply.write('format binary_little_endian 1.0\n')
+    ply.write("comment Author: Phil Wilkes\n")
+    for comment in comments:
+        ply.write("comment {}\n".format(comment))
+    ply.write("obj_info generated with {}\n".format(obj_info))
+    ply.write("element vertex {:0{}d}\n".format(n, pad))
+    for ptype, name in properties:
+        ply.write("property {} {}\n".format(ptype, name))
+    ply.write("end_header\n")
+
+def patch_vertex_count(output_name, n, pad):
+
+    with open(output_name, 'r+b') as ply:
+        header = ply.read(1024)
+        pos = header.index(b'element vertex ') + len('element vertex ')
+        ply.seek(pos)
+        ply.write('{:0{}d}'.format(n, pad).encode())
 
 def write_ply(output_name, pc, comments=[]):
 
     cols = ['x', 'y', 'z']
     pc[['x', 'y', 'z']] = pc[['x', 'y', 'z']].astype('f8')
+    properties = [('float64', 'x'), ('float64', 'y'), ('float64', 'z')]
+
+    if 'red' in pc.columns:
+        cols += ['red', 'green', 'blue']
+        pc[['red', 'green', 'blue']] = pc[['red', 'green', 'blue']].astype('i')
+        properties += [('int', 'red'), ('int', 'green'), ('int', 'blue')]
+    for col in pc.columns:
+        if col in cols: continue
+        try:
+            pc[col] = pc[col].astype('f8')
+            properties += [('float64', col)]
+            cols += [col]
+        except:
+            pass
 
     with open(output_name, 'w') as ply:
-
-        ply.write("ply\n")
-        ply.write('format binary_little_endian 1.0\n')
-        ply.write("comment Author: Phil Wilkes\n")
-        for comment in comments:
-            ply.write("comment {}\n".format(comment))
-        ply.write("obj_info generated with pcd2ply.py\n")
-        ply.write("element vertex {}\n".format(len(pc)))
-        ply.write("property float64 x\n")
-        ply.write("property float64 y\n")
-        ply.write("property float64 z\n")
-        if 'red' in pc.columns:
-            cols += ['red', 'green', 'blue']
-            pc[['red', 'green', 'blue']] = pc[['red', 'green', 'blue']].astype('i')
-            ply.write("property int red\n")
-            ply.write("property int green\n")
-            ply.write("property int blue\n")
-        for col in pc.columns:
-            if col in cols: continue
-            try:
-                pc[col] = pc[col].astype('f8')
-                ply.write("property float64 {}\n".format(col))
-                cols += [col]
-            except:
-                pass
-        ply.write("end_header\n")
+        write_ply_header(ply, len(pc), properties, comments=comments)
 
     with open(output_name, 'ab') as ply:
         ply.write(pc[cols].to_records(index=False).tobytes()) 
@@ -105,6 +157,7 @@ if __name__ == '__main__':
                         help='Path to a .ply file')
     parser.add_argument('-o', '--output', type=str, default=None,
                         help="Path to save converted PLY file; default is current directory with suffix '_float64.ply'")
+    add_profile_args(parser)
     args = parser.parse_args()
 
     if not args.input.lower().endswith('.ply'):
@@ -117,7 +170,10 @@ if __name__ == '__main__':
         name, ext = os.path.splitext(os.path.basename(args.input))
         output_path = os.path.join(os.getcwd(), f"{name}_float64.ply")
 
-    df = read_ply(args.input)
-    print(f"\nConverting: \n{os.path.abspath(args.input)}\n")
-    write_ply(output_path, df)
+    with Profiler('ply2float64', args.input, args.profile, args.cprofile) as prof:
+        df = read_ply(args.input, prof=prof)
+        print(f"\nConverting: \n{os.path.abspath(args.input)}\n")
+        with prof.stage('write'):
+            write_ply(output_path, df)
+        prof.count_bytes(output_path)
     print(f"Saved to: \n{output_path}\n")
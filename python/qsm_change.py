@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from cyl2ply import pandas2ply
+from mat2qsm import QSM
+
+def load_epoch(mats):
+
+    """
+    concatenates the cylinders of one or more QSMs, bid is a branch ID
+    unique across all the trees of the epoch
+    """
+
+    epoch = []
+    offset = 0
+    for mat in mats:
+        cyls = QSM(mat).cyl2pd()
+        cyls['tree'] = os.path.splitext(os.path.basename(mat))[0]
+        cyls['bid'] = cyls.branch.astype(int) + offset
+        offset = cyls.bid.max() + 1
+        epoch.append(cyls)
+
+    cyls = pd.concat(epoch, ignore_index=True)
+    cyls['volume'] = np.pi * cyls.radius ** 2 * cyls.length
+
+    return cyls
+
+def midpoints(cyls):
+
+    return cyls[['sx', 'sy', 'sz']].values + .5 * cyls.length.values[:, None] * cyls[['ax', 'ay', 'az']].values
+
+def match_cylinders(cyls1, cyls2, max_dist=.1, max_angle=30, k=8):
+
+    """
+    for every cylinder of epoch 2 returns the index of the matching cylinder
+    of epoch 1 (-1 if none) and the distance between their midpoints. Candidates
+    are the k nearest midpoints within max_dist whose axes differ by less than
+    max_angle degrees, the best candidate minimises the sum of the normalised
+    distance and direction difference
+    """
+
+    index = cKDTree(midpoints(cyls1))
+    dist, idx = index.query(midpoints(cyls2), k=k, distance_upper_bound=max_dist)
+    dist, idx = dist.reshape(len(cyls2), -1), idx.reshape(len(cyls2), -1)
+    valid = idx < len(cyls1)
+    idx[~valid] = 0
+
+    a1 = cyls1[['ax', 'ay', 'az']].values
+    a2 = cyls2[['ax', 'ay', 'az']].values
+    cos = np.abs(np.einsum('nkj,nj->nk', a1[idx], a2))
+    cos_max = np.cos(np.deg2rad(max_angle))
+    valid &= cos >= cos_max
+
+    score = dist / max_dist + (1 - cos) / max(1 - cos_max, 1e-9)
+    score[~valid] = np.inf
+    best = np.argmin(score, axis=1)
+    rows = np.arange(len(cyls2))
+
+    match = np.where(valid[rows, best], idx[rows, best], -1)
+    return match, np.where(match >= 0, dist[rows, best], np.nan)
+
+def compare_branches(cyls1, cyls2, match):
+
+    pairs = pd.DataFrame({'bid1':cyls1.bid.values[match[match >= 0]],
+                          'bid2':cyls2.bid.values[match >= 0],
+                          'dradius':cyls2.radius.values[match >= 0] - cyls1.radius.values[match[match >= 0]]})
+
+    # branches are paired one-to-one, greedily by the number of shared
+    # cylinders: a single pass over the votes, strongest first, takes every
+    # pair whose branches are both still free
+    votes = pairs.groupby(['bid1', 'bid2']).size().rename('n').reset_index()
+    votes = votes.sort_values(['n', 'bid1', 'bid2'], ascending=[False, True, True])
+    used1, used2, take = set(), set(), np.zeros(len(votes), dtype=bool)
+    for i, (bid1, bid2) in enumerate(zip(votes.bid1.values, votes.bid2.values)):
+        if bid1 not in used1 and bid2 not in used2:
+            used1.add(bid1)
+            used2.add(bid2)
+            take[i] = True
+    # empty when no cylinder was matched, e.g. a felled tree or epochs that
+    # are not co-registered: every branch is then lost or new
+    paired = votes[take].set_index('bid1')
+    # epoch 1 branches whose cylinders all went to a branch paired with
+    # another one were merged into that branch
+    merged = votes[~votes.bid1.isin(paired.index)].drop_duplicates('bid1').set_index('bid1')
+
+    def summarise(cyls):
+        return cyls.groupby('bid').agg(tree=('tree', 'first'), branch=('branch', 'first'),
+                                       BranchOrder=('BranchOrder', 'first'), length=('length', 'sum'),
+                                       volume=('volume', 'sum'), radius=('radius', 'max'), n_cyl=('radius', 'size'))
+
+    b1, b2 = summarise(cyls1), summarise(cyls2)
+
+    table = b1.join(paired.bid2)
+    table = table.join(b2[['branch', 'length', 'volume', 'radius']].add_suffix('_2'), on='bid2')
+    table['dlength'] = table.length_2 - table.length
+    table['dvolume'] = table.volume_2 - table.volume
+    table['dradius'] = pairs.groupby('bid1').dradius.mean()
+    table['status'] = np.where(table.bid2.isnull(), 'lost', 'matched')
+
+    # lost and merged branches count as removed length and volume, a merged
+    # branch refers to the epoch 2 branch it was merged into
+    unpaired = table.bid2.isnull()
+    table.loc[unpaired, 'dlength'] = -table.length[unpaired]
+    table.loc[unpaired, 'dvolume'] = -table.volume[unpaired]
+    into = table.index.isin(merged.index)
+    table.loc[into, 'branch_2'] = b2.branch.reindex(merged.bid2.reindex(table.index[into])).values
+    table.loc[into, 'status'] = 'merged'
+
+    new = b2[~b2.index.isin(paired.bid2)].rename(columns={'branch':'branch_2', 'length':'length_2',
+                                                           'volume':'volume_2', 'radius':'radius_2'})
+    new['status'] = 'new'
+    new['dlength'] = new.length_2
+    new['dvolume'] = new.volume_2
+
+    table = pd.concat([table.reset_index(drop=True), new.reset_index(drop=True)], ignore_index=True)
+    return table[['tree', 'branch', 'branch_2', 'BranchOrder', 'status', 'length', 'length_2', 'dlength',
+                  'volume', 'volume_2', 'dvolume', 'radius', 'radius_2', 'dradius', 'n_cyl']]
+
+def qsm_change(mats1, mats2, out, max_dist=.1, max_angle=30, k=8, mesh=True):
+
+    cyls1, cyls2 = load_epoch(mats1), load_epoch(mats2)
+    match, dist = match_cylinders(cyls1, cyls2, max_dist=max_dist, max_angle=max_angle, k=k)
+
+    # cylinder table: epoch 2 cylinders plus the epoch 1 cylinders nothing was matched to
+    cyls2['match'] = match
+    cyls2['dist'] = dist
+    cyls2['dradius'] = np.where(match >= 0, cyls2.radius.values - cyls1.radius.values[match], np.nan)
+    cyls2['status'] = np.where(match >= 0, 0, 1)
+    lost = cyls1[~np.isin(np.arange(len(cyls1)), match)].copy()
+    lost['match'] = -1
+    lost['status'] = -1
+    diff = pd.concat([cyls2, lost], ignore_index=True)
+    branches = compare_branches(cyls1, cyls2, match)
+
+    diff.to_csv(out + '_cylinders.csv', index=False)
+    branches.to_csv(out + '_branches.csv', index=False)
+
+    if mesh:
+        # status: 0 matched, 1 new, -1 lost
+        diff['dradius'] = diff.dradius.fillna(0)
+        pandas2ply(diff, ['status', 'dradius'], out + '_diff.ply')
+
+    return diff, branches
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=('Compare QSMs of the same tree(s) from two epochs. The point clouds '
+                                                   'of both epochs must be co-registered.'))
+    parser.add_argument('-a', '--epoch1', nargs='+', required=True, help='.mat file(s) of the earlier epoch')
+    parser.add_argument('-b', '--epoch2', nargs='+', required=True, help='.mat file(s) of the later epoch')
+    parser.add_argument('-o', '--output', default='qsm_change',
+                        help=('Output prefix, writes PREFIX_branches.csv, PREFIX_cylinders.csv and PREFIX_diff.ply '
+                              '(default: %(default)s)'))
+    parser.add_argument('-d', '--max_dist', type=float, default=.1,
+                        help='maximum distance between matched cylinder midpoints in metres (default: %(default)s)')
+    parser.add_argument('--max_angle', type=float, default=30,
+                        help='maximum angle between matched cylinder axes in degrees (default: %(default)s)')
+    parser.add_argument('-k', type=int, default=8,
+                        help='number of nearest cylinders considered for each match (default: %(default)s)')
+    parser.add_argument('--no_mesh', action='store_true', help='do not write the diff mesh')
+    args = parser.parse_args()
+
+    diff, branches = qsm_change(args.epoch1, args.epoch2, args.output, max_dist=args.max_dist,
+                                max_angle=args.max_angle, k=args.k, mesh=not args.no_mesh)
+
+    print(branches.groupby('status').agg(n=('status', 'size'), dlength=('dlength', 'sum'), dvolume=('dvolume', 'sum')))
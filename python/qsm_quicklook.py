@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+import os
+import html
+import zlib
+import struct
+import argparse
+import numpy as np
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor
+
+from mat2qsm import QSM
+
+# RGB colours by branch order, orders above 5 use the last colour
+palette = np.array([[140,  81,  10],
+                    [216, 179, 101],
+                    [ 90, 174,  97],
+                    [ 27, 120,  55],
+                    [ 67, 147, 195],
+                    [118,  42, 131]], dtype=float)
+
+# side view: x to the right, z up, looking along +y
+# top view: x to the right, y up, looking down -z
+views = {'side':(0, 2, 1), 'top':(0, 1, 2)}
+
+def write_png(fp, img):
+
+    """writes an (h, w, 3) uint8 array as an 8-bit RGB PNG"""
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    h, w, _ = img.shape
+    raw = np.hstack([np.zeros((h, 1), dtype=np.uint8), img.reshape(h, w * 3)]) # filter type 0 per row
+
+    with open(fp, 'wb') as png:
+        png.write(b'\x89PNG\r\n\x1a\n')
+        png.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)))
+        png.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        png.write(chunk(b'IEND', b''))
+
+def disc(r):
+
+    o = np.arange(-r, r + 1)
+    u, v = np.meshgrid(o, o)
+    inside = u ** 2 + v ** 2 <= r ** 2 + r
+    return u[inside], v[inside]
+
+def render(cyls, view, size=512, margin=8, background=255):
+
+    """
+    rasterises the cylinders as capsules: each axis is sampled and a disc
+    of the cylinder radius is drawn at every sample, the nearest sample
+    wins through a z-buffer
+    """
+
+    h, v, d = views[view]
+    start = cyls[['sx', 'sy', 'sz']].values
+    end = start + cyls.length.values[:, None] * cyls[['ax', 'ay', 'az']].values
+    rad = cyls.radius.values
+    order = np.clip(cyls.BranchOrder.values.astype(int), 0, len(palette) - 1)
+
+    lo = np.minimum(start, end).min(axis=0) - rad.max()
+    hi = np.maximum(start, end).max(axis=0) + rad.max()
+    pixel = max(hi[h] - lo[h], hi[v] - lo[v]) / (size - 2 * margin)
+    width = int(np.ceil((hi[h] - lo[h]) / pixel)) + 2 * margin
+    height = int(np.ceil((hi[v] - lo[v]) / pixel)) + 2 * margin
+
+    # sample every axis at half the radius in pixels, discs of neighbouring
+    # samples then overlap enough to leave no gaps
+    ps = (start[:, [h, v, d]] - lo[[h, v, d]]) / pixel
+    pe = (end[:, [h, v, d]] - lo[[h, v, d]]) / pixel
+    step = np.maximum(rad / pixel / 2, 1)
+    n = np.ceil(np.linalg.norm(pe[:, :2] - ps[:, :2], axis=1) / step).astype(int) + 1
+    cyl = np.repeat(np.arange(len(cyls)), n)
+    t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(np.maximum(n - 1, 1), n)
+    samples = ps[cyl] + t[:, None] * (pe[cyl] - ps[cyl])
+    r = np.maximum(np.round(rad[cyl] / pixel).astype(int), 0)
+
+    pix, depth, colour = [], [], []
+    for R in np.unique(r):
+        I = r == R
+        du, dv = disc(R)
+        x = (samples[I, 0, None] + margin + du).round().astype(int)
+        y = (height - 1 - margin - samples[I, 1, None] - dv).round().astype(int)
+        valid = ((x >= 0) & (x < width) & (y >= 0) & (y < height)).ravel()
+        pix.append((y * width + x).ravel()[valid])
+        depth.append(np.repeat(samples[I, 2], len(du))[valid])
+        colour.append(np.repeat(order[cyl[I]], len(du))[valid])
+    pix, depth, colour = np.concatenate(pix), np.concatenate(depth), np.concatenate(colour)
+
+    # z-buffer: keep the sample nearest to the viewer for every pixel
+    if view == 'top': depth = -depth
+    first = np.lexsort((depth, pix))
+    pix, depth, colour = pix[first], depth[first], colour[first]
+    keep = np.r_[True, pix[1:] != pix[:-1]]
+    pix, depth, colour = pix[keep], depth[keep], colour[keep]
+
+    # shade by depth so overlapping branches stay distinguishable
+    shade = 1 - .5 * (depth - depth.min()) / max(np.ptp(depth), 1e-9)
+    img = np.full((width * height, 3), background, dtype=np.uint8)
+    img[pix] = (palette[colour] * shade[:, None]).astype(np.uint8)
+
+    return img.reshape(height, width, 3)
+
+def treedata(qsm, field):
+
+    return float(np.ravel(getattr(qsm, field))[0])
+
+def quicklook(mat, odir, size=512, overwrite=False):
+
+    name = os.path.splitext(os.path.basename(mat))[0]
+    images = {view:os.path.join(odir, '{}_{}.png'.format(name, view)) for view in views}
+    summary = {'name':name, 'images':images}
+
+    try:
+        qsm = QSM(mat)
+        for field in ['TotalVolume', 'TreeHeight', 'DBHcyl']:
+            summary[field] = treedata(qsm, field)
+
+        if overwrite or not all(os.path.isfile(png) and os.path.getmtime(png) >= os.path.getmtime(mat)
+                                for png in images.values()):
+            cyls = qsm.cyl2pd()
+            for view, png in images.items():
+                write_png(png, render(cyls, view, size=size))
+
+    except Exception as err:
+        print(mat, err)
+        summary['error'] = str(err)
+
+    return summary
+
+def contact_sheet(summaries, fp, size=512):
+
+    with open(fp, 'w') as sheet:
+        sheet.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>QSM quick-look</title>\n')
+        sheet.write('<style>body{font-family:sans-serif} figure{display:inline-block;margin:4px;'
+                    'vertical-align:top} img{height:%dpx;border:1px solid #ccc} '
+                    'figcaption{font-size:small}</style>\n</head>\n<body>\n' % (size // 2))
+        for s in summaries:
+            sheet.write('<figure>\n')
+            if 'error' in s:
+                sheet.write('<figcaption><b>{}</b><br>{}</figcaption>\n'.format(html.escape(s['name']),
+                                                                                html.escape(s['error'])))
+            else:
+                for png in s['images'].values():
+                    src = quote(os.path.relpath(png, os.path.dirname(fp)))
+                    sheet.write('<img src="{}" loading="lazy">\n'.format(html.escape(src)))
+                sheet.write('<figcaption><b>{}</b><br>volume {:.3f} height {:.2f} DBH {:.3f}</figcaption>\n'.format(
+                            html.escape(s['name']), s['TotalVolume'], s['TreeHeight'], s['DBHcyl']))
+            sheet.write('</figure>\n')
+        sheet.write('</body>\n</html>\n')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render side and top-down PNG quick-looks of QSM .mat files and an HTML contact sheet.')
+    parser.add_argument('-i', '--input_mat_files', nargs='+', required=True,
+                        help='One or multiple .mat files to render')
+    parser.add_argument('-o', '--odir', default=None,
+                        help='Directory to save images and index.html; default is current directory')
+    parser.add_argument('-s', '--size', type=int, default=512,
+                        help='Size of the longest image side in pixels (default: %(default)s)')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of .mat files rendered in parallel (default: %(default)s)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Render even if the images are newer than the .mat file')
+    args = parser.parse_args()
+
+    odir = os.getcwd() if args.odir is None else os.path.abspath(args.odir)
+    os.makedirs(odir, exist_ok=True)
+    n = len(args.input_mat_files)
+
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            summaries = list(pool.map(quicklook, args.input_mat_files, [odir] * n, [args.size] * n,
+                                      [args.overwrite] * n, chunksize=max(1, n // (4 * args.processes))))
+    else:
+        summaries = [quicklook(mat, odir, args.size, args.overwrite) for mat in args.input_mat_files]
+
+    contact_sheet(summaries, os.path.join(odir, 'index.html'), size=args.size)
+    print(f"Rendered {n} models, contact sheet: \n{os.path.join(odir, 'index.html')}\n")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import numpy as np
+
+from cyl2ply import pandas2ply, filter_branches
+from mat2qsm import QSM
+
+def reindex(cyls, keep):
+
+    """
+    drops cylinders and renumbers the 1-based parent and extension links,
+    links to dropped cylinders become 0
+    """
+
+    Ind = np.zeros(len(cyls) + 1, dtype=int)
+    Ind[1:][keep] = np.arange(1, keep.sum() + 1)
+
+    cyls = cyls[keep].copy()
+    cyls['parent'] = Ind[cyls.parent.values.astype(int)]
+    cyls['extension'] = Ind[cyls.extension.values.astype(int)]
+
+    return cyls.reset_index(drop=True)
+
+def sort_cylinders(cyls):
+
+    # merging relies on the cylinders of a branch being consecutive and in order
+    order = np.lexsort((cyls.PositionInBranch.values, cyls.branch.values))
+    if (order == np.arange(len(cyls))).all(): return cyls
+
+    Ind = np.zeros(len(cyls) + 1, dtype=int)
+    Ind[order + 1] = np.arange(1, len(cyls) + 1)
+    cyls = cyls.iloc[order].reset_index(drop=True)
+    cyls['parent'] = Ind[cyls.parent.values.astype(int)]
+    cyls['extension'] = Ind[cyls.extension.values.astype(int)]
+
+    return cyls
+
+def merge_cylinders(cyls, max_dradius=.1, max_angle=10):
+
+    """
+    merges disjoint pairs of consecutive cylinders of a branch whose radii
+    differ by less than max_dradius (relative) and whose axes differ by less
+    than max_angle degrees. The merged cylinder runs from the start of the
+    first to the end of the second and its radius keeps the volume of the pair
+    """
+
+    n = len(cyls)
+    idx = np.arange(n)
+    S = cyls[['sx', 'sy', 'sz']].values
+    A = cyls[['ax', 'ay', 'az']].values
+    L = cyls.length.values
+    R = cyls.radius.values
+    branch = cyls.branch.values
+
+    nxt = np.minimum(idx + 1, n - 1)
+    join = (cyls.extension.values == idx + 2) & (branch[nxt] == branch) & (idx < n - 1)
+    join &= np.abs(R[nxt] - R) <= max_dradius * np.maximum(R, R[nxt])
+    join &= np.einsum('ij,ij->i', A, A[nxt]) >= np.cos(np.deg2rad(max_angle))
+
+    # within a run of joinable cylinders pair the 1st with the 2nd, 3rd with 4th, ...
+    run_start = np.maximum.accumulate(np.where(np.r_[True, ~join[:-1]], idx, 0))
+    head = join & ((idx - run_start) % 2 == 0)
+    tail = np.r_[False, head[:-1]]
+    if not head.any(): return cyls, 0
+
+    h, t = idx[head], idx[head] + 1
+    E = S[t] + L[t, None] * A[t]
+    a = E - S[h]
+    l = np.linalg.norm(a, axis=1)
+    V = np.pi * (R[h] ** 2 * L[h] + R[t] ** 2 * L[t])
+
+    cyls = cyls.copy()
+    cyls.loc[h, ['ax', 'ay', 'az']] = a / l[:, None]
+    cyls.loc[h, 'length'] = l
+    cyls.loc[h, 'radius'] = np.sqrt(V / l / np.pi)
+    cyls.loc[h, 'extension'] = cyls.extension.values[t]
+
+    # children of removed cylinders are attached to the cylinder replacing them
+    par = cyls.parent.values.astype(int)
+    moved = (par > 0) & tail[np.maximum(par - 1, 0)]
+    cyls.loc[moved, 'parent'] = par[moved] - 1
+
+    cyls = reindex(cyls, ~tail)
+    cyls['PositionInBranch'] = cyls.groupby('branch').cumcount().values + 1
+
+    return cyls, len(h)
+
+def simplify_qsm(cyls, branch, max_order=None, min_radius=0, iterations=3, max_dradius=.1, max_angle=10):
+
+    """
+    python version of simplify_qsm.m working on the cyl2pd and branch2pd
+    tables. Removes branches above max_order, branches thinner than
+    min_radius at their base together with their children, then merges
+    consecutive cylinders for the given number of iterations. Returns the
+    simplified cylinder and branch tables
+    """
+
+    cyls = sort_cylinders(cyls)
+    keep = np.ones(len(cyls), dtype=bool)
+
+    ## Maximum branching order
+    if max_order is not None:
+        keep &= cyls.BranchOrder.values <= max_order
+
+    ## Small branches
+    if min_radius > 0:
+        branch = branch.copy()
+        if 'BDia' not in branch.columns:
+            # QSM 2.0 has no branch diameter, use the first cylinder
+            base = cyls[cyls.PositionInBranch == 1].set_index('branch').radius
+            branch['BDia'] = 2 * base.reindex(branch.index, fill_value=0)
+        branch['BLen'] = branch.BLen.fillna(0)
+        passed = filter_branches(branch, 0, min_radius)
+        keep &= passed.reindex(cyls.branch.values, fill_value=False).values
+
+    cyls = reindex(cyls, keep)
+    branch = branch[branch.index.isin(cyls.branch.unique())]
+
+    ## Cylinder merging
+    for i in range(iterations):
+        cyls, merged = merge_cylinders(cyls, max_dradius=max_dradius, max_angle=max_angle)
+        if merged == 0: break
+
+    return cyls, branch
+
+def volume(cyls):
+
+    return (np.pi * cyls.radius ** 2 * cyls.length).sum()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Simplify QSM .mat files and export them as .ply meshes.')
+    parser.add_argument('-i', '--input_mat_files', nargs='+', required=True,
+                        help='One or multiple .mat files to process')
+    parser.add_argument('-o', '--odir', default=None,
+                        help="Directory to save the simplified .ply files, named <input>_simple.ply; default is current directory")
+    parser.add_argument('--max_order', type=int, default=None,
+                        help='Maximum branch order, higher order branches are removed')
+    parser.add_argument('-r', '--min_radius', type=float, default=0,
+                        help='Branches with a smaller radius at their base are removed with their child branches')
+    parser.add_argument('-n', '--iterations', type=int, default=3,
+                        help='Number of merging passes, each pass at most halves the cylinders of a branch (default: %(default)s)')
+    parser.add_argument('--max_dradius', type=float, default=.1,
+                        help='Maximum relative radius difference of merged cylinders (default: %(default)s)')
+    parser.add_argument('--max_angle', type=float, default=10,
+                        help='Maximum angle in degrees between axes of merged cylinders (default: %(default)s)')
+    parser.add_argument('-f', '--fields', nargs='+', default=['branch', 'BranchOrder', 'radius'],
+                        help='Cylinder attributes written as vertex properties. Default: %(default)s')
+    args = parser.parse_args()
+
+    odir = os.getcwd() if args.odir is None else os.path.abspath(args.odir)
+    os.makedirs(odir, exist_ok=True)
+
+    for mat in args.input_mat_files:
+
+        qsm = QSM(mat)
+        cyls, branch = qsm.cyl2pd(), qsm.branch2pd()
+        simple, _ = simplify_qsm(cyls, branch, max_order=args.max_order, min_radius=args.min_radius,
+                                 iterations=args.iterations, max_dradius=args.max_dradius, max_angle=args.max_angle)
+
+        out_ply = os.path.join(odir, os.path.splitext(os.path.basename(mat))[0] + '_simple.ply')
+        pandas2ply(simple, args.fields, out_ply)
+
+        print('{}: {} -> {} cylinders, volume {:.4f} -> {:.4f} m3 ({:+.2%})'.format(
+              mat, len(cyls), len(simple), volume(cyls), volume(simple), volume(simple) / volume(cyls) - 1))
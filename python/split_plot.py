@@ -0,0 +1,170 @@
+import argparse
+import os
+import numpy as np
+
+from ply2float64 import read_ply, read_ply_header, write_ply_header, patch_vertex_count
+
+class TreeWriter:
+
+    """
+    buffers the points of each tree in memory and appends them to the
+    tree's own PLY once the buffer is large enough, files are only open
+    while being written to so thousands of trees do not exhaust file handles.
+    Once all buffers together exceed max_buffered the largest ones are
+    flushed, memory is bounded however many trees the plot has
+    """
+
+    def __init__(self, odir, prefix, properties, pad, buffer_size=2**20, max_buffered=2**28):
+
+        self.odir = odir
+        self.prefix = prefix
+        self.properties = properties
+        self.pad = pad
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.total = 0
+        self.buffers = {}
+        self.buffered = {}
+        self.counts = {}
+
+    def path(self, tree):
+
+        return os.path.join(self.odir, '{}{}.ply'.format(self.prefix, tree))
+
+    def append(self, tree, arr):
+
+        if tree not in self.counts:
+            with open(self.path(tree), 'w') as ply:
+                write_ply_header(ply, 0, self.properties, obj_info='split_plot.py', pad=self.pad)
+            self.buffers[tree] = []
+            self.buffered[tree] = 0
+            self.counts[tree] = 0
+
+        self.buffers[tree].append(arr.tobytes())
+        self.buffered[tree] += arr.nbytes
+        self.total += arr.nbytes
+        self.counts[tree] += len(arr)
+
+        if self.buffered[tree] >= self.buffer_size:
+            self.flush(tree)
+        elif self.total > self.max_buffered:
+            # flush down to half the budget so the next appends do not flush again
+            for t in sorted(self.buffered, key=self.buffered.get, reverse=True):
+                if self.total <= self.max_buffered // 2: break
+                self.flush(t)
+
+    def flush(self, tree):
+
+        with open(self.path(tree), 'ab') as ply:
+            ply.write(b''.join(self.buffers[tree]))
+        self.total -= self.buffered[tree]
+        self.buffers[tree] = []
+        self.buffered[tree] = 0
+
+    def close(self):
+
+        for tree in self.counts:
+            if self.buffered[tree] > 0: self.flush(tree)
+            patch_vertex_count(self.path(tree), self.counts[tree], self.pad)
+
+def read_chunks(fp, dtype, length, chunk_size):
+
+    with open(fp, 'rb') as ply:
+        ply.seek(length)
+        while True:
+            chunk = np.fromfile(ply, dtype=dtype, count=chunk_size)
+            if len(chunk) == 0: break
+            yield chunk
+
+def tree_name(value):
+
+    value = value.item()
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    return value
+
+def split_plot(fp, odir, tree_field='treeID', fields=None, ignore=[], prefix=None,
+               chunk_size=2**22, buffer_size=2**20, max_buffered=2**28, verbose=False):
+
+    N, dtype, fmt, length = read_ply_header(fp)
+
+    if tree_field not in dtype.names:
+        raise ValueError('{} has no property {}'.format(fp, tree_field))
+
+    # keep the wood/leaf label read_ply.m looks for unless told otherwise
+    if fields is None:
+        fields = [f for f in ['label', 'leaf'] if f in dtype.names]
+    out_dtype = [('x', '<f8'), ('y', '<f8'), ('z', '<f8')] + [(f, '<f8') for f in fields]
+    properties = [('float64', f) for f, _ in out_dtype]
+
+    if prefix is None:
+        prefix = os.path.splitext(os.path.basename(fp))[0] + '_'
+    writer = TreeWriter(odir, prefix, properties, len(str(N)), buffer_size=buffer_size,
+                        max_buffered=max_buffered)
+
+    if fmt == 'ascii':
+        # ascii bodies cannot be streamed with a fixed record size
+        body = read_ply(fp).to_records(index=False)
+        chunks = (body[i:i + chunk_size] for i in range(0, N, chunk_size))
+    else:
+        chunks = read_chunks(fp, dtype, length, chunk_size)
+
+    read = 0
+    for chunk in chunks:
+
+        read += len(chunk)
+
+        ids = chunk[tree_field]
+        if len(ignore) > 0:
+            chunk = chunk[~np.isin(ids, ignore)]
+            ids = chunk[tree_field]
+
+        # sort the chunk by tree so each tree is one contiguous slice
+        order = np.argsort(ids, kind='stable')
+        trees, start = np.unique(ids[order], return_index=True)
+
+        out = np.empty(len(chunk), dtype=out_dtype)
+        for f, _ in out_dtype:
+            out[f] = chunk[f][order]
+
+        for tree, arr in zip(trees, np.split(out, start[1:])):
+            writer.append(tree_name(tree), arr)
+
+        if verbose: print('\t{} of {} points read, {} trees'.format(read, N, len(writer.counts)))
+
+    writer.close()
+
+    return writer.counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split a segmented plot PLY into one float64 PLY per tree in a single pass')
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help='Path to the plot .ply file')
+    parser.add_argument('-o', '--odir', type=str, default=None,
+                        help='Directory to save the per-tree PLY files; default is current directory')
+    parser.add_argument('-t', '--tree_field', type=str, default='treeID',
+                        help='property holding the tree ID (default: %(default)s)')
+    parser.add_argument('-f', '--fields', type=str, nargs='*', default=None,
+                        help='properties copied along with x, y, z; default is label/leaf if present')
+    parser.add_argument('--ignore', type=float, nargs='*', default=[],
+                        help='tree IDs to drop e.g. 0 for unsegmented points')
+    parser.add_argument('--prefix', type=str, default=None,
+                        help="output filename prefix, files are named PREFIX<treeID>.ply; default is '<input name>_'")
+    parser.add_argument('--chunk_size', type=int, default=2**22,
+                        help='number of points read at a time (default: %(default)s)')
+    parser.add_argument('--buffer_size', type=int, default=2**20,
+                        help='bytes buffered per tree before appending to its file (default: %(default)s)')
+    parser.add_argument('--max_buffered', type=int, default=2**28,
+                        help=('bytes buffered for all trees together, the largest buffers are flushed early '
+                              'once exceeded (default: %(default)s)'))
+    parser.add_argument('--verbose', action='store_true', help='print some stuff to screen')
+    args = parser.parse_args()
+
+    odir = os.getcwd() if args.odir is None else os.path.abspath(args.odir)
+    os.makedirs(odir, exist_ok=True)
+
+    print(f"\nSplitting: \n{os.path.abspath(args.input)}\n")
+    counts = split_plot(args.input, odir, tree_field=args.tree_field, fields=args.fields,
+                        ignore=args.ignore, prefix=args.prefix, chunk_size=args.chunk_size,
+                        buffer_size=args.buffer_size, max_buffered=args.max_buffered, verbose=args.verbose)
+    print(f"Saved {len(counts)} trees ({sum(counts.values())} points) to: \n{odir}\n")
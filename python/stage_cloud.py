@@ -0,0 +1,67 @@
+import argparse
+import os
+import hashlib
+import numpy as np
+
+from ply2float64 import read_ply, read_ply_header
+
+# same selection as the .m files written by generate_inputs: if the cloud has
+# a label (or leaf) property only points labelled as wood are kept
+WOOD = 3
+
+def staged_path(fp, stage_dir):
+
+    # stage_dir is typically shared by several projects, the hash of the
+    # absolute path keeps clouds with the same basename apart
+    name = os.path.splitext(os.path.basename(fp))[0]
+    digest = hashlib.sha1(os.path.abspath(fp).encode()).hexdigest()[:10]
+    return os.path.join(stage_dir, '{}-{}.bin'.format(name, digest))
+
+def stage_cloud(fp, stage_dir, overwrite=False):
+
+    """
+    decodes a PLY once into stage_dir/<name>-<hash>.bin as raw little-endian float64
+    stored column by column (x, y, z), the layout read_bin.m memory-maps.
+    Returns the path of the .bin file and the number of points
+    """
+
+    out = staged_path(fp, stage_dir)
+
+    if not overwrite and os.path.isfile(out) and os.path.getmtime(out) >= os.path.getmtime(fp):
+        return out, os.path.getsize(out) // 24
+
+    N, dtype, fmt, length = read_ply_header(fp)
+    if fmt == 'binary':
+        pc = np.memmap(fp, dtype=dtype, mode='r', offset=length, shape=(N,))
+    else:
+        pc = read_ply(fp).to_records(index=False)
+
+    label = [f for f in ['label', 'leaf'] if f in pc.dtype.names]
+    if len(label) > 0:
+        pc = pc[pc[label[0]] == WOOD]
+
+    os.makedirs(stage_dir, exist_ok=True)
+    # written under a temporary name so jobs never map a partial file
+    tmp = out + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'wb') as fh:
+        for c in ['x', 'y', 'z']:
+            np.ascontiguousarray(pc[c], dtype='<f8').tofile(fh)
+    os.replace(tmp, out)
+
+    return out, len(pc)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Decode PLY file(s) once into raw float64 .bin files that the TreeQSM '
+                                                  '.m drivers memory-map with read_bin.m'))
+    parser.add_argument('-i', '--input', type=str, nargs='+', required=True,
+                        help='Path to one or more .ply files')
+    parser.add_argument('-s', '--stage_dir', type=str, default='/dev/shm/treeqsm',
+                        help='Directory on local tmpfs/SSD to write the .bin files to (default: %(default)s)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Stage even if the .bin file is newer than the .ply file')
+    args = parser.parse_args()
+
+    for ply in args.input:
+        out, N = stage_cloud(ply, args.stage_dir, overwrite=args.overwrite)
+        print(f"Staged {N} points: \n{out}")
@@ -4,6 +4,8 @@ TREEQSM="/data/TLS2/tools/qsm/TreeQSM-2.3.1-mod-matlab/python/"
 CLOUD_DIR="/PATH/TO/clouds/float64"
 PARAMS_DIR="/PATH/TO/models/intermediate/params"
 QSM_CANDIDATE_DIR="/PATH/TO/models/qsm_candidates"
+# Optional: decode each cloud once into local tmpfs for run_treeqsm_parallel.sh, e.g. STAGE_DIR=/dev/shm/treeqsm
+STAGE_DIR=${STAGE_DIR:-}
 
 for ply_file in "${CLOUD_DIR}"/*.ply; do
     base_name=$(basename "${ply_file}" .ply)
@@ -17,5 +19,6 @@ for ply_file in "${CLOUD_DIR}"/*.ply; do
         --patchdiam2min 0.05 0.1 0.15 \
         --patchdiam2max 0.15 0.2 0.25 \
         -n 3 \
-        --lcyl 4
+        --lcyl 4 \
+        ${STAGE_DIR:+--stage_dir "${STAGE_DIR}"}
 done
\ No newline at end of file
@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Set directory paths
+QSM="/data/TLS2/tools/qsm/TreeQSM-2.3.1-mod-matlab/python/"
+LAS_DIR="/data/TLS2/uk/epping-pollards/demo/clouds"
+OUT_DIR="/data/TLS2/uk/epping-pollards/demo/clouds/float64"
+
+# Convert every .las file in LAS_DIR in one call
+python "${QSM}/las2float64.py" -i "${LAS_DIR}"/*.las -o "${OUT_DIR}"
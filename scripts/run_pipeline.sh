@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# Watch DATA/clouds, DATA/models/qsm_candidates and DATA/models/optqsm and
+# run every tree through the next step as soon as its inputs appear.
+# Stop with Ctrl-C, finished steps are skipped on restart.
+
+TREEQSM="/data/TLS2/tools/qsm/TreeQSM-2.3.1-mod-matlab/python/"
+OPTQSM="/data/TLS2/tools/qsm/optqsm-mod-matlab/src/"
+DATA="/PATH/TO/DATA"
+
+python "${TREEQSM}/pipeline.py" \
+    -r "${DATA}" \
+    --optqsm_src "${OPTQSM}" \
+    --param_args "--patchdiam1 0.2 0.25 0.3 --patchdiam2min 0.05 0.1 0.15 --patchdiam2max 0.15 0.2 0.25 -n 3 --lcyl 4" \
+    --treeqsm_jobs ${MAX_JOBS:-3} \
+    --optqsm_jobs 1
@@ -0,0 +1,22 @@
+function xyz = read_bin(fn, ncols)
+    % Reads a point cloud staged by stage_cloud.py: raw little-endian
+    % float64 stored column by column (all x, then all y, then all z).
+    % The file is memory-mapped, so parallel jobs reading the same file
+    % share the page cache instead of each decoding the PLY.
+    if nargin < 2
+        ncols = 3;
+    end
+
+    info = dir(fn);
+    if isempty(info)
+        error('Could not open file: %s', fn);
+    end
+
+    N = info.bytes / 8 / ncols;
+    if N ~= floor(N)
+        error('Size of %s is not a multiple of %d float64 columns', fn, ncols);
+    end
+
+    m = memmapfile(fn, 'Format', {'double', [N, ncols], 'xyz'}, 'Repeat', 1);
+    xyz = m.Data.xyz;
+end